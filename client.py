@@ -1,15 +1,17 @@
 import argparse
-import json, time, os, sys
-from enum import Enum
-from pathlib import Path
+import json, time, os, threading
+from enum import IntEnum
 
 import rclpy
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
 from rclpy.qos import QoSProfile, ReliabilityPolicy, HistoryPolicy, DurabilityPolicy
 import std_msgs.msg
+from builtin_interfaces.msg import Time
 from geometry_msgs.msg import PoseWithCovarianceStamped, PoseStamped, PoseWithCovariance
 from aw_monitor.srv import *
 from autoware_adapi_v1_msgs.srv import InitializeLocalization, ChangeOperationMode, ClearRoute
+from autoware_adapi_v1_msgs.msg import OperationModeState, RouteState
 from autoware_vehicle_msgs.msg import Engage
 import utils
 
@@ -36,7 +38,10 @@ AWSIM_CLIENT_OP_STATE_STOPPED = 1
 AWSIM_CLIENT_OP_STATE_RUNNING = 2
 AWSIM_CLIENT_OP_STATE_AUTO_MODE = 3
 
-class AdsInternalStatus(Enum):
+# request to despawn all NPCs; constant, so it is encoded only once
+NPC_REMOVING_ALL_REQUEST = json.dumps({"target": ""})
+
+class AdsInternalStatus(IntEnum):
     UNINITIALIZED = 0
     LOCALIZATION_SUCCEEDED = 1
     GOAL_SET = 2
@@ -44,37 +49,50 @@ class AdsInternalStatus(Enum):
     AUTONOMOUS_IN_PROGRESS = 4
     GOAL_ARRIVED = 5
 
-    def __lt__(self, other):
-        if isinstance(other, AdsInternalStatus):
-            return self.value < other.value
-        return NotImplemented
-    def __le__(self, other):
-        if isinstance(other, AdsInternalStatus):
-            return self.value <= other.value
-        return NotImplemented
-
-    def __ge__(self, other):
-        if isinstance(other, AdsInternalStatus):
-            return self.value >= other.value
-        return NotImplemented
-    def __gt__(self, other):
-        if isinstance(other, AdsInternalStatus):
-            return self.value > other.value
-        return NotImplemented
-
 class ClientNode(Node):
     def __init__(self):
         super().__init__('awsimscript_client')
         self.timestep = 0.1
         self.ads_internal_status = AdsInternalStatus.UNINITIALIZED
-        self.ego_motion_state = MOTION_STATE_STOPPED
         self.published_finish_signal = False
-
+        # latest states received from Autoware AD API
+        self.is_autonomous_mode_available = False
+        self.routing_state = ROUTING_STATE_UNKNOWN
+        # guards transitions of ads_internal_status, which happen from subscription callbacks,
+        # and is notified on each of them
+        self._state_cv = threading.Condition()
+
+        # messages and requests reused across calls; only stamps are refreshed before sending
+        self._engage_msg = Engage(engage=True)
+        self._goal_msg = PoseStamped()
+        self._goal_msg.header.frame_id = 'map'
+        self._int32_running = std_msgs.msg.Int32(data=AWSIM_CLIENT_OP_STATE_RUNNING)
+        self._int32_auto = std_msgs.msg.Int32(data=AWSIM_CLIENT_OP_STATE_AUTO_MODE)
+        self._int32_stopped = std_msgs.msg.Int32(data=AWSIM_CLIENT_OP_STATE_STOPPED)
+        self._npc_removing_msg = std_msgs.msg.String(data=NPC_REMOVING_ALL_REQUEST)
+        self._npc_removing_req = DynamicControl.Request(json_request=NPC_REMOVING_ALL_REQUEST)
+        self._recording_state_req = MonitorRecordingState.Request()
+        self._clear_route_req = ClearRoute.Request()
+
+        # All topics of this client carry one-shot commands or rare state transitions,
+        # not high-rate streams, so they use RELIABLE with depth 1: a lost command
+        # would stall the scenario, and only the latest value matters.
+        # BEST_EFFORT (e.g., qos_profile_sensor_data) is only worth it for
+        # high-rate sensor-like streams, where dropping a sample is harmless.
         qos_profile = QoSProfile(
             reliability=ReliabilityPolicy.RELIABLE,
             history=HistoryPolicy.KEEP_LAST,
             depth=1
         )
+        # TRANSIENT_LOCAL makes late-joining subscribers still receive the last value.
+        # Only for state-like topics: a latched command (script, engage, NPC removal)
+        # would be replayed to a subscriber that restarts or joins between scenarios.
+        latched_qos = QoSProfile(
+            reliability=ReliabilityPolicy.RELIABLE,
+            history=HistoryPolicy.KEEP_LAST,
+            durability=DurabilityPolicy.TRANSIENT_LOCAL,
+            depth=1
+        )
         # publishers
         self.awsim_scenario_publisher = self.create_publisher(
             std_msgs.msg.String,
@@ -85,7 +103,7 @@ class ClientNode(Node):
         self.ego_goal_publisher = self.create_publisher(
             PoseStamped,
             '/planning/mission_planning/goal',
-            qos_profile
+            latched_qos
         )
         # autonomous engage command
         self.ego_auto_engage_publisher = self.create_publisher(
@@ -103,12 +121,26 @@ class ClientNode(Node):
         self.client_op_status_publisher = self.create_publisher(
             std_msgs.msg.Int32,
             '/awsim_script_client/scenario_op_status',
-            QoSProfile(
-                reliability=ReliabilityPolicy.RELIABLE,
-                history=HistoryPolicy.KEEP_LAST,
-                durability=DurabilityPolicy.TRANSIENT_LOCAL,
-                depth=1
-            )
+            latched_qos
+        )
+
+        # subscriptions
+        # execution state of Autoware: operation mode, routing state.
+        # AD API publishes them only on changes with transient local durability, so the
+        # subscriptions must be RELIABLE + TRANSIENT_LOCAL too: with BEST_EFFORT or VOLATILE,
+        # a missed transition would never be re-sent, and the current state would not be
+        # received on startup.
+        self.operation_mode_state_sub = self.create_subscription(
+            OperationModeState,
+            '/api/operation_mode/state',
+            self._on_operation_mode_state,
+            latched_qos
+        )
+        self.routing_state_sub = self.create_subscription(
+            RouteState,
+            '/api/routing/state',
+            self._on_routing_state,
+            latched_qos
         )
 
         # service clients
@@ -124,12 +156,6 @@ class ClientNode(Node):
             '/api/localization/initialize'
         )
 
-        # execution state of AWSIM and Autoware, include: motion state, routing state, operation state
-        self.execution_state_client = self.create_client(
-            ExecutionState,
-            '/simulation/gt_srv/execution_state'
-        )
-
         # recording state of AW-RuntimeMonitor (e.g., recording, trace writing, trace written, etc.)
         self.recording_state_client = self.create_client(
             MonitorRecordingState,
@@ -146,12 +172,41 @@ class ClientNode(Node):
             '/dynamic_control/vehicle/removing_srv',
         )
 
+        # names of services already confirmed available; services do not disappear mid-run
+        self._ready_clients = set()
+
+    def _ensure_ready(self, client):
+        """
+        Wait until the service of the given client is available.
+        Once a service is confirmed available, later calls return immediately.
+        """
+        if client.srv_name in self._ready_clients:
+            return
+        backoff = (0.1, 0.2, 0.5, 1.0, 2.0)
+        attempt = 0
+        while not client.wait_for_service(timeout_sec=backoff[min(attempt, len(backoff) - 1)]):
+            attempt += 1
+            if attempt >= len(backoff):
+                print(f'[WARNING] {client.srv_name} ROS service not available, waiting...')
+        self._ready_clients.add(client.srv_name)
+
+    def _await(self, future):
+        """
+        Block until a service future completes. The node is spun by an executor
+        in a background thread, so other callbacks keep being processed meanwhile.
+        """
+        done = threading.Event()
+        future.add_done_callback(lambda _f: done.set())
+        done.wait()
+        return future.result()
 
     def send_request(self, file_path):
+        """
+        :return: True if the script was loaded and the ego started driving autonomously
+        """
         self.publish_start_signal()
 
-        while not self.awsim_scenario_client.wait_for_service(timeout_sec=5.0):
-            print('[WARNING] /dynamic_control/script/awsim_script_srv ROS service not available, waiting...')
+        self._ensure_ready(self.awsim_scenario_client)
 
         my_dict = {
             "file": file_path,
@@ -167,8 +222,7 @@ class ClientNode(Node):
         req = DynamicControl.Request()
         req.json_request = msg.data
         future = self.awsim_scenario_client.call_async(req)
-        rclpy.spin_until_future_complete(self, future)
-        response = future.result()
+        response = self._await(future)
         if response.status.success:
             self.get_logger().info(f"Script file {file_path} was processed properly.")
             try:
@@ -176,32 +230,34 @@ class ClientNode(Node):
                 if self.re_localization(initpose_and_goal['initial_pose']):
                     # re-localization succeeded
                     self.set_goal(initpose_and_goal['goal'])
-                    self.ads_internal_status = AdsInternalStatus.GOAL_SET
-                    self.loop()
+                    with self._state_cv:
+                        self.ads_internal_status = AdsInternalStatus.GOAL_SET
+                    return self.loop()
 
             except json.decoder.JSONDecodeError:
-                self.logger.error(f"Ego initial pose and goal are unknown. Message: {response.status.message}")
+                self.get_logger().error(f"Ego initial pose and goal are unknown. Message: {response.status.message}")
         else:
             self.get_logger().error(f"AWSIM failed to process the script file, "
                   f"error message: {response.status.message}.")
+        return False
 
     def re_localization(self, pose_cov):
-        while not self.init_localization_request.wait_for_service(timeout_sec=5.0):
-            print('[WARNING] Localization initialization ROS service not available, waiting...')
+        self._ensure_ready(self.init_localization_request)
 
+        # pose and covariance are invariant across retries, only the stamp is refreshed
         req = InitializeLocalization.Request()
         req.pose.append(PoseWithCovarianceStamped())
-        req.pose[0].header.frame_id = 'map'
+        header = req.pose[0].header
+        header.frame_id = 'map'
 
-        req.pose[0].pose.pose = utils.dict_to_ros_pose(pose_cov['pose'])
-        req.pose[0].pose.covariance = pose_cov['covariance']
+        req.pose[0].pose = utils.dict_to_ros_pose_with_covariance(pose_cov)
 
         retry = 0
         while retry < 10:
-            req.pose[0].header.stamp = self.get_clock().now().to_msg()
+            now_ns = self.get_clock().now().nanoseconds
+            header.stamp = Time(sec=now_ns // 1_000_000_000, nanosec=now_ns % 1_000_000_000)
             future = self.init_localization_request.call_async(req)
-            rclpy.spin_until_future_complete(self, future)
-            response = future.result()
+            response = self._await(future)
 
             if response.status.success:
                 self.get_logger().info("Re-Localization succeeded.")
@@ -215,89 +271,107 @@ class ClientNode(Node):
         return False
 
     def set_goal(self, goal):
-        msg = PoseStamped()
+        msg = self._goal_msg
         msg.header.stamp = self.get_clock().now().to_msg()
-        msg.header.frame_id = 'map'
         msg.pose = utils.dict_to_ros_pose(goal)
         self.ego_goal_publisher.publish(msg)
         self.get_logger().info('Setting Ego destination done')
 
     def send_engage_cmd(self):
-        msg = Engage()
+        msg = self._engage_msg
         msg.stamp = self.get_clock().now().to_msg()
-        msg.engage = True
 
         self.ego_auto_engage_publisher.publish(msg)
         self.get_logger().info("Autonomous mode activated.")
         self.ads_internal_status = AdsInternalStatus.AUTONOMOUS_IN_PROGRESS
         # self.publish_in_auto_mode_signal()
 
-    def upd_execution_state(self):
-        response = self.query_execution_state()
+    def _on_operation_mode_state(self, msg):
+        with self._state_cv:
+            self.is_autonomous_mode_available = msg.is_autonomous_mode_available
+        self.upd_execution_state()
 
-        self.ego_motion_state = response.motion_state
-        if response.is_autonomous_mode_available and \
-                self.ads_internal_status < AdsInternalStatus.AUTONOMOUS_MODE_READY:
-            self.get_logger().info("Autonomous operation mode is ready")
-            self.ads_internal_status = AdsInternalStatus.AUTONOMOUS_MODE_READY
-            self.send_engage_cmd()
-            self.publish_in_auto_mode_signal()
+    def _on_routing_state(self, msg):
+        with self._state_cv:
+            self.routing_state = msg.state
+        self.upd_execution_state()
 
-        if (response.routing_state == ROUTING_STATE_ARRIVED and
-                self.ads_internal_status == AdsInternalStatus.AUTONOMOUS_IN_PROGRESS):
-            self.get_logger().info("Arrived destination")
-            self.ads_internal_status = AdsInternalStatus.GOAL_ARRIVED
+    def upd_execution_state(self):
+        with self._state_cv:
+            # engage only once the goal of the current script is set
+            if self.is_autonomous_mode_available and \
+                    self.ads_internal_status == AdsInternalStatus.GOAL_SET:
+                self.get_logger().info("Autonomous operation mode is ready")
+                self.ads_internal_status = AdsInternalStatus.AUTONOMOUS_MODE_READY
+                # only an arrival received after engaging ends the scenario,
+                # not a stale one left from the previous scenario
+                self.routing_state = ROUTING_STATE_UNKNOWN
+                self.send_engage_cmd()
+                self.publish_in_auto_mode_signal()
+                self._state_cv.notify_all()
+
+            if (self.routing_state == ROUTING_STATE_ARRIVED and
+                    self.ads_internal_status == AdsInternalStatus.AUTONOMOUS_IN_PROGRESS):
+                self.get_logger().info("Arrived destination")
+                self.ads_internal_status = AdsInternalStatus.GOAL_ARRIVED
+                self._state_cv.notify_all()
+
+    def wait_for_status(self, status, timeout=None):
+        """
+        Block until ads_internal_status reaches the given status.
+        :return: False if the timeout expired before
+        """
+        with self._state_cv:
+            return self._state_cv.wait_for(lambda: self.ads_internal_status >= status, timeout=timeout)
 
     def loop(self):
-        while self.ads_internal_status < AdsInternalStatus.AUTONOMOUS_IN_PROGRESS:
-            self.upd_execution_state()
-            time.sleep(1)
-
-    def query_execution_state(self):
-        while not self.execution_state_client.wait_for_service(timeout_sec=5.0):
-            print('[WARNING] Execution state ROS service not available, waiting...')
+        # autonomous mode may have become available before the goal was set
+        self.upd_execution_state()
+        # _state_cv is reentrant: hold it across the wait and the give-up below
+        with self._state_cv:
+            if self.wait_for_status(AdsInternalStatus.AUTONOMOUS_IN_PROGRESS, timeout=60):
+                return True
+            # give up the scenario, so that a late state update does not engage the ego anymore
+            self.ads_internal_status = AdsInternalStatus.UNINITIALIZED
+        self.get_logger().error("Autonomous operation mode did not become ready.")
+        return False
 
-        # Create a request
-        req = ExecutionState.Request()
-        future = self.execution_state_client.call_async(req)
-        rclpy.spin_until_future_complete(self, future)
-        return future.result()
+    def reset_state(self):
+        """
+        Reset the execution state before the next script.
+        """
+        with self._state_cv:
+            self.ads_internal_status = AdsInternalStatus.UNINITIALIZED
+            self.routing_state = ROUTING_STATE_UNKNOWN
+            self.published_finish_signal = False
 
     def query_recording_state(self):
-        while not self.recording_state_client.wait_for_service(timeout_sec=5.0):
-            print('[WARNING] Monitor Recording state ROS service not available, waiting...')
+        self._ensure_ready(self.recording_state_client)
 
-        req = MonitorRecordingState.Request()
-        future = self.recording_state_client.call_async(req)
-        rclpy.spin_until_future_complete(self, future)
-        return future.result()
+        future = self.recording_state_client.call_async(self._recording_state_req)
+        return self._await(future)
 
-    def clear_route(self):
-        while not self.clear_route_client.wait_for_service(timeout_sec=5.0):
-            print('[WARNING] Route clearing ROS service not available, waiting...')
+    def clear_route_and_remove_npcs(self):
+        """
+        Clear the route and despawn NPCs, with both service round-trips in flight at the same time.
+        """
+        self._ensure_ready(self.clear_route_client)
 
-        req = ClearRoute.Request()
-        future = self.clear_route_client.call_async(req)
-        rclpy.spin_until_future_complete(self, future)
-        response = future.result()
+        clear_route_future = self.clear_route_client.call_async(self._clear_route_req)
+        self.remove_npcs()
+        response = self._await(clear_route_future)
         self.get_logger().info(f"Route clearing: {response.status.success}, {response.status.message}")
 
     def remove_npcs(self):
-        my_dict = {
-            "target": "",
-        }
-        msg = std_msgs.msg.String()
-        msg.data = json.dumps(my_dict)
-        self.npc_removing_publisher.publish(msg)
+        self.npc_removing_publisher.publish(self._npc_removing_msg)
 
         # do a service request to confirm the despawning
-        req = DynamicControl.Request()
-        req.json_request = msg.data
+        self._ensure_ready(self.npc_removing_client)
+        req = self._npc_removing_req
         retry = 0
         while retry < 10:
             future = self.npc_removing_client.call_async(req)
-            rclpy.spin_until_future_complete(self, future)
-            response = future.result()
+            response = self._await(future)
             if response.status.success:
                 self.get_logger().info(f"NPCs removed.")
                 break
@@ -310,20 +384,14 @@ class ClientNode(Node):
 
     def publish_start_signal(self):
         # publish running signal
-        msg = std_msgs.msg.Int32()
-        msg.data = AWSIM_CLIENT_OP_STATE_RUNNING
-        self.client_op_status_publisher.publish(msg)
+        self.client_op_status_publisher.publish(self._int32_running)
 
     def publish_in_auto_mode_signal(self):
-        msg = std_msgs.msg.Int32()
-        msg.data = AWSIM_CLIENT_OP_STATE_AUTO_MODE
-        self.client_op_status_publisher.publish(msg)
+        self.client_op_status_publisher.publish(self._int32_auto)
 
     def publish_finish_signal(self):
         if not self.published_finish_signal:
-            msg = std_msgs.msg.Int32()
-            msg.data = AWSIM_CLIENT_OP_STATE_STOPPED
-            self.client_op_status_publisher.publish(msg)
+            self.client_op_status_publisher.publish(self._int32_stopped)
             self.published_finish_signal = True
 
 class AWSIMScriptClient:
@@ -334,56 +402,50 @@ class AWSIMScriptClient:
         :param wait_writing_trace:
         """
         self.node = node
-        self.dir_path = Path(dir_path)
+        self.dir_path = dir_path
         self.wait_writing_trace = wait_writing_trace
-        self.ready_for_new_script = False
 
     def execute(self):
-        script_files = sorted(
-            [f for f in self.dir_path.glob("*.script") if f.is_file()],
-            key=lambda f: f.name
-        )
+        # DirEntry already carries the file type, no extra stat per file
+        with os.scandir(self.dir_path) as it:
+            script_files = sorted(
+                (e.path for e in it if e.is_file() and e.name.endswith('.script')),
+                key=os.path.basename
+            )
         for script_file in script_files:
-            self.node.send_request(str(script_file))
-            time.sleep(15)
-            self.loop_wait()
+            if self.node.send_request(script_file):
+                self.loop_wait()
+            else:
+                print(f"[ERROR] Scenario {script_file} did not start, skipping it.")
             self.reset()
             time.sleep(3)
 
     def loop_wait(self):
-        while not self.ready_for_new_script:
-            self.node.upd_execution_state()
-            if self.node.ads_internal_status == AdsInternalStatus.GOAL_ARRIVED:
-                self.node.publish_finish_signal()
-                if not self.wait_writing_trace:
-                    break
-                else:
-                    res = self.node.query_recording_state()
-                    if (res.state is not MonitorRecordingState.Response.WRITING_DATA and
-                            res.state is not MonitorRecordingState.Response.RECORDING):
-                        break
-            print("[INFO] Waiting Ego arrive goal.")
+        print("[INFO] Waiting Ego arrive goal.")
+        self.node.wait_for_status(AdsInternalStatus.GOAL_ARRIVED)
+        self.node.publish_finish_signal()
+        if not self.wait_writing_trace:
+            return
+
+        # the recording state is only available as a service
+        while True:
+            res = self.node.query_recording_state()
+            if (res.state is not MonitorRecordingState.Response.WRITING_DATA and
+                    res.state is not MonitorRecordingState.Response.RECORDING):
+                break
+            print("[INFO] Waiting for the monitor to write the trace.")
             time.sleep(2)
 
     def reset(self):
-        self.ready_for_new_script = False
-        self.node.clear_route()
-        self.node.remove_npcs()
-        self.node.ads_internal_status = AdsInternalStatus.UNINITIALIZED
-        self.node.ego_motion_state = MOTION_STATE_STOPPED
-        self.node.published_finish_signal = False
+        self.node.clear_route_and_remove_npcs()
+        self.node.reset_state()
 
 def loop_wait(node):
-    while True:
-        node.upd_execution_state()
-        if node.ads_internal_status == AdsInternalStatus.GOAL_ARRIVED:
-            node.publish_finish_signal()
-            break
-        print("[INFO] Waiting Ego arrive goal.")
-        time.sleep(2)
+    print("[INFO] Waiting Ego arrive goal.")
+    node.wait_for_status(AdsInternalStatus.GOAL_ARRIVED)
+    node.publish_finish_signal()
 
-    node.clear_route()
-    node.remove_npcs()
+    node.clear_route_and_remove_npcs()
 
 
 def parse_args():
@@ -400,6 +462,9 @@ if __name__ == '__main__':
     args = parse_args()
     rclpy.init()
     node = ClientNode()
+    executor = MultiThreadedExecutor(num_threads=4)
+    executor.add_node(node)
+    threading.Thread(target=executor.spin, daemon=True).start()
 
     full_path = os.path.abspath(args.file_or_dir)
     to_wait_writing_trace = True
@@ -409,11 +474,14 @@ if __name__ == '__main__':
     if os.path.isdir(full_path):
         AWSIMScriptClient(node, full_path, to_wait_writing_trace).execute()
     elif os.path.isfile(full_path):
-        node.send_request(full_path)
-        time.sleep(15)
-        loop_wait(node)
+        if node.send_request(full_path):
+            loop_wait(node)
+        else:
+            print(f"[ERROR] Scenario {full_path} did not start.")
+            node.clear_route_and_remove_npcs()
     else:
         print('[ERROR] File or directory not found.')
 
+    executor.shutdown()
     node.destroy_node()
     rclpy.shutdown()
@@ -1,5 +1,18 @@
+import numpy
+
 from geometry_msgs.msg import Pose, PoseWithCovariance
 
+# Numeric list fields must be converted before being assigned into a message,
+# so that rclpy keeps the value as is instead of checking and converting it element by element:
+# - sequence fields (e.g., float64[], uint8[]) are stored as array.array: assign an array.array
+# - fixed-size array fields (e.g., float64[36]) are stored as numpy.ndarray: use to_ros_fixed_array
+
+def to_ros_fixed_array(values, dtype=numpy.float64):
+    """
+    :param dtype: numpy dtype of the field, e.g., numpy.float64 for float64[36]
+    """
+    return numpy.asarray(values, dtype=dtype)
+
 def dict_to_ros_pose(input):
     pose = Pose()
     pose.position.x = input['position']['x']
@@ -10,3 +23,9 @@ def dict_to_ros_pose(input):
     pose.orientation.z = input['quaternion']['z']
     pose.orientation.w = input['quaternion']['w']
     return pose
+
+def dict_to_ros_pose_with_covariance(input):
+    pose_cov = PoseWithCovariance()
+    pose_cov.pose = dict_to_ros_pose(input['pose'])
+    pose_cov.covariance = to_ros_fixed_array(input['covariance'], numpy.float64)
+    return pose_cov